@@ -1,7 +1,10 @@
+import asyncio
+import hashlib
 import json
 import os
 import re
 import random
+import time
 from nonebot import require
 from pathlib import Path
 
@@ -16,6 +19,16 @@ from nonebot.adapters.onebot.v11 import GroupMessageEvent, Bot, Event, MessageEv
 from nonebot.rule import to_me, Rule
 
 SUPERUSERS = get_driver().config.superusers
+
+# 人数上报限流配置（每分钟可恢复的次数 / 令牌桶容量 / 重复上报的合并窗口秒数，设为 0 表示关闭）
+JTJ_USER_RATE_LIMIT = float(getattr(get_driver().config, "jtj_user_rate_limit", 6))
+JTJ_USER_BURST = float(getattr(get_driver().config, "jtj_user_burst", 3))
+JTJ_GROUP_RATE_LIMIT = float(getattr(get_driver().config, "jtj_group_rate_limit", 30))
+JTJ_GROUP_BURST = float(getattr(get_driver().config, "jtj_group_burst", 10))
+JTJ_DUPLICATE_WINDOW = float(getattr(get_driver().config, "jtj_duplicate_window", 30))
+# 检查 arcade_data.json 变更的间隔秒数，设为 0 表示关闭自动重载
+JTJ_WATCH_INTERVAL = float(getattr(get_driver().config, "jtj_watch_interval", 10))
+
 __plugin_meta__ = PluginMetadata(
     name="机厅",
     description="本地机厅管理和人数上报",
@@ -30,6 +43,87 @@ def ends_with_j_j_few_or_digit(event: GroupMessageEvent) -> bool:
     message = event.get_message().extract_plain_text().strip()
     return bool(re.search(r'(j|J|几|\d)$', message))
 
+
+# 令牌桶状态：键 -> [剩余令牌, 上次更新时间]
+user_buckets = {}
+group_buckets = {}
+# 每个机厅最近一次人数变更后的人数：机厅名称 -> (人数, 时间)
+last_counts = {}
+# 被拒绝的上报次数统计
+rate_limit_stats = {"user": 0, "group": 0, "duplicate": 0}
+
+
+def match_count_report(message, keyword):
+    """匹配消息中 <简称>数字/+-数字 形式的人数上报，返回操作符和数字的匹配结果"""
+    return re.search(f"{re.escape(keyword)}(\\+|\\-)?(\\d+)", message)
+
+
+def find_count_report(message, region):
+    """在指定地区的机厅中查找消息上报的机厅，返回 (机厅, 简称, 匹配结果)，只使用内存中的机厅数据"""
+    for arcade in current_arcade_data:
+        if arcade["region"] != region:
+            continue
+        for keyword in arcade["keywords"]:
+            if message.startswith(keyword):
+                match = match_count_report(message, keyword)
+                if match:
+                    return arcade, keyword, match
+    return None
+
+
+def refill_bucket(buckets, key, rate, burst, now):
+    """按经过的时间补充令牌，返回该键对应的令牌桶"""
+    burst = max(1, burst)
+    bucket = buckets.setdefault(key, [burst, now])
+    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate / 60)
+    bucket[1] = now
+    return bucket
+
+
+# 定义规则函数，对人数上报进行去重和限流，在读写文件之前拒绝多余的上报
+# 使用 async 使其在事件循环中执行，避免并发上报时令牌桶的竞争
+async def check_report_rate(event: GroupMessageEvent) -> bool:
+    # Rule 中的各个检查会同时执行，这里自行判断结尾，避免无效消息消耗令牌
+    if not ends_with_j_j_few_or_digit(event):
+        return False
+
+    message = event.get_message().extract_plain_text().strip()
+    report = find_count_report(message, bound_regions.get(str(event.group_id)))
+    if not report:
+        return True
+
+    now = time.monotonic()
+    report_key = (event.group_id, event.user_id)
+
+    # 机厅人数刚变更为相同数字时，重复的上报直接合并；+-数字的上报不是幂等的，不参与合并
+    arcade, _, match = report
+    operator, number_str = match.groups()
+    last_count = last_counts.get(arcade["primary_keyword"])
+    if JTJ_DUPLICATE_WINDOW > 0 and not operator and last_count and last_count[0] == int(number_str) and now - last_count[1] < JTJ_DUPLICATE_WINDOW:
+        rate_limit_stats["duplicate"] += 1
+        return False
+
+    user_bucket = None
+    group_bucket = None
+    if JTJ_USER_RATE_LIMIT > 0 and JTJ_USER_BURST > 0:
+        user_bucket = refill_bucket(user_buckets, report_key, JTJ_USER_RATE_LIMIT, JTJ_USER_BURST, now)
+        if user_bucket[0] < 1:
+            rate_limit_stats["user"] += 1
+            return False
+    if JTJ_GROUP_RATE_LIMIT > 0 and JTJ_GROUP_BURST > 0:
+        group_bucket = refill_bucket(group_buckets, event.group_id, JTJ_GROUP_RATE_LIMIT, JTJ_GROUP_BURST, now)
+        if group_bucket[0] < 1:
+            rate_limit_stats["group"] += 1
+            return False
+
+    # 两个令牌桶都通过后才扣除令牌
+    if user_bucket:
+        user_bucket[0] -= 1
+    if group_bucket:
+        group_bucket[0] -= 1
+    return True
+
+
 plugin_data_dir: Path = store.get_plugin_data_dir()
 # 文件路径
 ARCADE_DATA_FILE: Path = store.get_plugin_data_file("arcade_data.json")
@@ -164,8 +258,14 @@ def read_group_region():
         return {}
 
 def save_group_region(group_region):
+    global bound_regions
     with GROUP_REGION_FILE.open('w', encoding='utf-8') as file:
         json.dump(group_region, file, ensure_ascii=False, indent=2)
+    bound_regions = dict(group_region)
+
+
+# 群组绑定地区的内存缓存，供上报限流规则使用
+bound_regions = read_group_region()
 
 
 def reset_state(region_name):
@@ -187,6 +287,7 @@ def reset_state(region_name):
     with open(STATE_FILE, 'w', encoding='utf-8') as file:
         json.dump(updated_data, file, ensure_ascii=False, indent=2)
 
+    last_counts.clear()
     sync_arcade_data()
     print("机厅人数已重置")
 
@@ -209,6 +310,7 @@ def reset_all_states():
     with open(STATE_FILE, 'w', encoding='utf-8') as file:
         json.dump(updated_data, file, ensure_ascii=False, indent=2)
 
+    last_counts.clear()
     sync_arcade_data()
     print("所有地区的机厅人数已重置")
 
@@ -220,6 +322,10 @@ scheduler = require("nonebot_plugin_apscheduler").scheduler
 @scheduler.scheduled_job("cron", hour=4, minute=0)
 async def scheduled_task():
     reset_all_states()  # 调用重置状态的函数
+    # 清理限流状态，避免长期累积
+    user_buckets.clear()
+    group_buckets.clear()
+    last_counts.clear()
     
   	
     
@@ -276,37 +382,45 @@ def format_arcades_message(arcades, region):
     return "\n".join(message_lines)
     
   
-arcade_handler = on_message(rule=Rule(ends_with_j_j_few_or_digit), priority=1, block=False)
+arcade_handler = on_message(rule=Rule(check_report_rate), priority=1, block=False)
 @arcade_handler.handle()
 async def handle_arcade(bot: Bot, event: GroupMessageEvent):
-    arcades = read_state()
     group_id = event.group_id
-    group_region = read_group_region().get(str(group_id))
+    group_region = bound_regions.get(str(group_id))
 
     message = event.get_message().extract_plain_text().strip()
     user_info = await bot.get_group_member_info(group_id=group_id, user_id=event.user_id)
     user_nickname = user_info.get('nickname', '') + "(" + event.get_user_id() + ")"
-    
+
+    # 获取昵称之后再读写 state.json，中间没有 await，避免覆盖等待期间自动重载的机厅变更
+    arcades = read_state()
     response = get_response(message, user_nickname, arcades, group_region)
     if response:
-        await arcade_handler.send(response)
         save_state(arcades)
 
+    if response:
+        await arcade_handler.send(response)
+
 
 def get_response(message, user_nickname, arcades, group_region):
-    region_arcades = [arcade for arcade in arcades if arcade["region"] == group_region]
+    # 简称与限流规则一样从内存中的机厅数据匹配，人数从 state.json 中读写
+    arcades_map = {arcade["primary_keyword"]: arcade for arcade in arcades}
     matching_arcades = []  # 用于存储匹配的机厅
 
-    for arcade in region_arcades:
-        for keyword in arcade["keywords"]:
-            if message.startswith(keyword):
-                updated = update_arcade_people_count(message, user_nickname, arcade, keyword)
-                if updated:
-                    save_state(arcades)
-                    return f"更新成功！\n{arcade['primary_keyword']}\n当前：{arcade['peopleCount']}人"
-                elif keyword + "几" in message or keyword + "j" in message or keyword + "J" in message:
-                    matching_arcades.append(arcade)  # 收集匹配的机厅
-                    
+    report = find_count_report(message, group_region)
+    if report and report[0]["primary_keyword"] in arcades_map:
+        arcade = arcades_map[report[0]["primary_keyword"]]
+        update_arcade_people_count(message, user_nickname, arcade, report[1])
+        save_state(arcades)
+        return f"更新成功！\n{arcade['primary_keyword']}\n当前：{arcade['peopleCount']}人"
+
+    for region_arcade in current_arcade_data:
+        if region_arcade["region"] != group_region or region_arcade["primary_keyword"] not in arcades_map:
+            continue
+        for keyword in region_arcade["keywords"]:
+            if message.startswith(keyword) and (keyword + "几" in message or keyword + "j" in message or keyword + "J" in message):
+                matching_arcades.append(arcades_map[region_arcade["primary_keyword"]])  # 收集匹配的机厅
+                
     if matching_arcades:
         # 发送所有匹配的机厅信息
         responses = []
@@ -320,7 +434,7 @@ def get_response(message, user_nickname, arcades, group_region):
 
 def update_arcade_people_count(message, user_nickname, arcade, keyword):
     # 使用正则表达式来匹配消息中的数字
-    match = re.search(f"{keyword}(\+|\-)?(\d+)", message)
+    match = match_count_report(message, keyword)
     if not match:
         return False
     # 提取操作符和数字
@@ -334,6 +448,8 @@ def update_arcade_people_count(message, user_nickname, arcade, keyword):
         arcade["peopleCount"] = number
     arcade["updatedBy"] = user_nickname
     arcade["lastUpdatedAt"] = datetime.now().strftime("%H:%M:%S")
+    # 记录变更后的人数，用于合并短时间内的重复上报
+    last_counts[arcade["primary_keyword"]] = (arcade["peopleCount"], time.monotonic())
     return True  # 表示更新成功
         
         
@@ -391,6 +507,153 @@ def sync_arcade_data():
     print("缓存已更新，新的机厅和地区已生效")
 
     
+# 查看上报限流统计
+rate_stats_handler = on_command("限流统计", priority=10, block=True)
+
+@rate_stats_handler.handle()
+async def handle_rate_stats(bot: Bot, event: GroupMessageEvent):
+    user_id = event.get_user_id()
+
+    if user_id not in SUPERUSERS:
+        await rate_stats_handler.send("您没有权限执行此操作")
+        return
+
+    await rate_stats_handler.send(
+        "已拦截的人数上报：\n"
+        f"用户限流：{rate_limit_stats['user']}次\n"
+        f"群组限流：{rate_limit_stats['group']}次\n"
+        f"重复上报：{rate_limit_stats['duplicate']}次"
+    )
+
+
+def read_arcade_data_file():
+    """读取 arcade_data.json，返回 (内容哈希, 解析后的数据)，内容不是合法 JSON 时数据为 None"""
+    content = ARCADE_DATA_FILE.read_bytes()
+    content_hash = hashlib.sha1(content).hexdigest()
+    try:
+        return content_hash, json.loads(content.decode('utf-8'))
+    except ValueError:
+        return content_hash, None
+
+
+def get_arcade_data_signature():
+    """获取 arcade_data.json 的文件签名：(修改时间, 大小, 内容哈希)"""
+    stat = ARCADE_DATA_FILE.stat()
+    content_hash, _ = read_arcade_data_file()
+    return stat.st_mtime_ns, stat.st_size, content_hash
+
+
+def is_valid_arcade_data(arcade_data):
+    """检查机厅数据的格式：列表中的每个机厅都包含名称、地区和简称列表"""
+    if not isinstance(arcade_data, list):
+        return False
+    for arcade in arcade_data:
+        if not isinstance(arcade, dict):
+            return False
+        if not isinstance(arcade.get("primary_keyword"), str) or not isinstance(arcade.get("region"), str):
+            return False
+        keywords = arcade.get("keywords")
+        if not isinstance(keywords, list) or not all(isinstance(keyword, str) for keyword in keywords):
+            return False
+    return True
+
+
+def diff_arcade_data(old_data, new_data):
+    """比较新旧机厅数据，返回新增、删除和变更（地区或简称不同）的机厅"""
+    old_map = {arcade["primary_keyword"]: arcade for arcade in old_data}
+    new_map = {arcade["primary_keyword"]: arcade for arcade in new_data}
+
+    added = [arcade for primary_keyword, arcade in new_map.items() if primary_keyword not in old_map]
+    removed = [arcade for primary_keyword, arcade in old_map.items() if primary_keyword not in new_map]
+    changed = [
+        arcade for primary_keyword, arcade in new_map.items()
+        if primary_keyword in old_map
+        and (arcade["region"] != old_map[primary_keyword]["region"] or arcade["keywords"] != old_map[primary_keyword]["keywords"])
+    ]
+    return added, removed, changed
+
+
+def apply_arcade_diff(added, removed, changed):
+    """只把变更的机厅应用到 state.json，保留其余机厅的人数数据"""
+    arcades = read_state()
+
+    # 删除已移除的机厅
+    removed_keywords = {arcade["primary_keyword"] for arcade in removed}
+    arcades = [arcade for arcade in arcades if arcade["primary_keyword"] not in removed_keywords]
+
+    # 更新地区和简称，人数数据保持不变
+    changed_map = {arcade["primary_keyword"]: arcade for arcade in changed}
+    for arcade in arcades:
+        if arcade["primary_keyword"] in changed_map:
+            arcade["region"] = changed_map[arcade["primary_keyword"]]["region"]
+            arcade["keywords"] = changed_map[arcade["primary_keyword"]]["keywords"]
+
+    # 新增的机厅（以及 state.json 中缺失的机厅）初始化人数数据
+    existing_keywords = {arcade["primary_keyword"] for arcade in arcades}
+    for arcade in added + changed:
+        if arcade["primary_keyword"] not in existing_keywords:
+            arcades.append({
+                "primary_keyword": arcade["primary_keyword"],
+                "keywords": arcade["keywords"],
+                "peopleCount": 0,
+                "updatedBy": "无",
+                "lastUpdatedAt": "04:00:00",
+                "region": arcade["region"]
+            })
+
+    save_state(arcades)
+
+
+# arcade_data.json 上次检查时的文件签名
+arcade_data_signature = get_arcade_data_signature()
+
+
+async def watch_arcade_data():
+    """检查 arcade_data.json 是否被外部修改，有变更时增量更新机厅数据"""
+    global arcade_data_signature, current_arcade_data
+    try:
+        stat = ARCADE_DATA_FILE.stat()
+    except FileNotFoundError:
+        return
+
+    # 修改时间和大小都没变时，不读取文件
+    if (stat.st_mtime_ns, stat.st_size) == arcade_data_signature[:2]:
+        return
+
+    # 在线程中读取和解析文件，避免阻塞事件循环
+    try:
+        content_hash, new_data = await asyncio.to_thread(read_arcade_data_file)
+    except OSError as e:
+        print(f"读取 arcade_data.json 失败，已跳过自动重载：{e}")
+        return
+
+    new_signature = (stat.st_mtime_ns, stat.st_size, content_hash)
+    if content_hash == arcade_data_signature[2]:
+        arcade_data_signature = new_signature
+        return
+
+    # 格式错误或应用失败时不更新签名，下次检查时重试
+    if not is_valid_arcade_data(new_data):
+        print("arcade_data.json 格式错误，已跳过自动重载")
+        return
+
+    added, removed, changed = diff_arcade_data(current_arcade_data, new_data)
+    if added or removed or changed:
+        try:
+            apply_arcade_diff(added, removed, changed)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"更新 state.json 失败，已跳过自动重载：{e}")
+            return
+        print(f"机厅数据已自动重载：新增 {len(added)} 个，删除 {len(removed)} 个，变更 {len(changed)} 个")
+
+    current_arcade_data = new_data
+    arcade_data_signature = new_signature
+
+
+if JTJ_WATCH_INTERVAL > 0:
+    scheduler.add_job(watch_arcade_data, "interval", seconds=JTJ_WATCH_INTERVAL)
+
+
 # 定义同步指令
 sync_handler = on_command("更新机厅", priority=10, block=True)
 